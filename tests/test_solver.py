@@ -0,0 +1,138 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from timetable._kernels import _run_shot
+from timetable.solver import Mutation, make_solver
+from timetable.structures import Timetable
+from timetable.validator import Validator
+
+ASSETS_DIR = Path(__file__).parent / 'assets'
+
+
+@pytest.fixture
+def solver():
+    with open(ASSETS_DIR / 'toy.in') as faculty_input:
+        return make_solver(
+            faculty_input,
+            violation_cost=100,
+            seed=42,
+            shots=4,
+            iterations=50,
+            slices=1,
+            slice_ratio=0.5,
+            max_consecutive_rejects=20,
+            sort_courses=True,
+            repeat_sliced_results=True,
+        )
+
+
+def random_move(timetable, rng):
+    c, p = rng.choice(np.argwhere(timetable.timetable))
+    room = timetable.timetable[c, p]
+    new_p = rng.choice(np.flatnonzero(timetable.timetable[c] == 0))
+    new_room = rng.integers(1, timetable.faculty.rooms + 1)
+    return c, p, new_p, room, new_room
+
+
+def test_delta_cost_matches_full_evaluation(solver):
+    rng = np.random.default_rng(solver.seed)
+    timetable = solver.init(rng)
+    validator = Validator(solver.faculty, timetable)
+    cost = solver.evaluate(timetable)
+
+    for _ in range(200):
+        moves = [random_move(timetable, rng)]
+        violations, soft = validator.delta_cost(moves)
+
+        new_timetable = timetable.clone()
+        for c, p, new_p, room, new_room in moves:
+            new_timetable.move(c, p, new_p, new_room)
+        rebuilt = Timetable.from_grid(solver.faculty, new_timetable.timetable.copy())
+        assert np.array_equal(new_timetable.room_lectures, rebuilt.room_lectures)
+        assert np.array_equal(new_timetable.curriculum_period_lectures, rebuilt.curriculum_period_lectures)
+        assert np.array_equal(new_timetable.course_daily_lectures, rebuilt.course_daily_lectures)
+        assert np.array_equal(new_timetable.working_days, rebuilt.working_days)
+        assert np.array_equal(new_timetable.course_room_lectures, rebuilt.course_room_lectures)
+        new_cost = solver.evaluate(new_timetable)
+        assert cost + violations * solver.violation_cost + soft == new_cost
+
+        if rng.random() < 0.5:
+            validator.commit(moves)
+            cost, timetable = new_cost, new_timetable
+
+
+def test_init_course_with_more_lectures_than_periods(solver):
+    solver.faculty.lectures_np = solver.faculty.lectures_np.copy()
+    solver.faculty.lectures_np[0] = solver.faculty.periods + 1
+
+    grid = solver.init(np.random.default_rng(solver.seed)).timetable
+    assert grid[0].all()
+    assert (np.count_nonzero(grid[1:], axis=1) == solver.faculty.lectures_np[1:]).all()
+
+
+@pytest.mark.parametrize('temperature', [0.0, 50.0])
+@pytest.mark.parametrize('mutation_count_chances', [{1: 1}, {1: 1, 2: 1, 3: 1}])
+def test_shot_cost_matches_evaluation(solver, mutation_count_chances, temperature):
+    solver.iterations = 2000
+    solver.max_consecutive_rejects = 2000
+    solver.temperature = temperature
+    solver.cooling_rate = 0.995
+    solver.mutation_count_chances = mutation_count_chances
+    solver.mutation_chances = {mutation: 1 for mutation in Mutation}
+
+    cost, grid = solver.shot(None, None, np.random.SeedSequence(solver.seed))
+    assert cost == solver.evaluate(Timetable.from_grid(solver.faculty, grid))
+    assert (np.count_nonzero(grid, axis=1) == solver.faculty.lectures_np).all()
+
+
+def test_run_shot_returns_best_seen_timetable(solver):
+    rng = np.random.default_rng(solver.seed)
+    timetable = solver.init(rng)
+    cost = solver.evaluate(timetable)
+    counters = Validator(solver.faculty, timetable).counters
+    mutation_count_chances, mutation_chances = solver.cumulative_chances
+
+    # Hot enough to accept plenty of worse moves, so the last state is not the best one
+    best_cost, best, _, _ = _run_shot(
+        counters, solver.faculty.data, rng, mutation_count_chances, mutation_chances,
+        2000, 2000, solver.violation_cost, cost, 1000.0, 1.0,
+    )
+    assert best_cost == solver.evaluate(Timetable.from_grid(solver.faculty, best))
+    assert best_cost <= cost
+    assert best_cost < solver.evaluate(Timetable.from_grid(solver.faculty, counters.timetable.copy()))
+
+
+def test_chances_changes_are_picked_up_after_shot(solver):
+    solver.shot(None, None, np.random.SeedSequence(solver.seed))
+    solver.mutation_count_chances = {2: 1}
+    solver.mutation_chances = {Mutation.swap_both: 1}
+
+    count_weights, mutation_weights = solver.cumulative_chances
+    assert count_weights.tolist() == [0, 0, 1]
+    assert mutation_weights.tolist() == [0, 0, 0, 0, 0, 1]
+
+
+def test_sort_courses_changes_are_picked_up(solver):
+    weights = np.array(solver.faculty.course_conflict_weights)
+    assert (np.diff(weights[solver.course_order]) <= 0).all()
+
+    solver.sort_courses = False
+    assert solver.course_order.tolist() == list(range(solver.faculty.courses))
+
+
+def test_do_the_thing_cost_matches_evaluation(solver):
+    cost, timetable = solver.do_the_thing()
+    assert cost == solver.evaluate(timetable)
+
+    # Restart from the found solution
+    restarted_cost, _ = solver.do_the_thing(timetable)
+    assert restarted_cost <= cost
+
+
+@pytest.mark.parametrize('slice_ratio', [1.0, 1.5])
+def test_do_the_thing_with_slice_ratio_above_one(solver, slice_ratio):
+    solver.slice_ratio = slice_ratio
+    cost, timetable = solver.do_the_thing()
+    assert cost == solver.evaluate(timetable)
@@ -0,0 +1,497 @@
+from functools import lru_cache
+from typing import NamedTuple, Tuple
+
+import numpy as np
+from numba import njit
+
+# Sets (of periods or courses) are packed 64 per uint64 word, bit i % 64 of word i // 64
+_ONE = np.uint64(1)
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_M7 = np.uint64(0x7F)
+
+
+@njit(cache=True)
+def _popcount(x: np.uint64) -> int:
+    # SWAR bit count, numba has no portable popcnt intrinsic
+    x = x - ((x >> _ONE) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    # Shift adds instead of multiplication, so there is no (warned) overflow without jit
+    x += x >> np.uint64(8)
+    x += x >> np.uint64(16)
+    x += x >> np.uint64(32)
+    return int(x & _M7)
+
+
+@njit(cache=True)
+def _nth_bit(x: np.uint64, n: int) -> int:
+    """Get index of the n-th (from 0) set bit of x"""
+    for _ in range(n):
+        x &= x - _ONE
+    return _popcount((x & (~x + _ONE)) - _ONE)
+
+
+@njit(cache=True)
+def _pack_bits(mask: np.ndarray) -> np.ndarray:
+    """Pack (rows X columns) truthy matrix into (rows X words) uint64 column sets"""
+    rows, columns = mask.shape
+    bits = np.zeros((rows, (columns + 63) // 64), dtype=np.uint64)
+    for row in range(rows):
+        for i in range(columns):
+            if mask[row, i]:
+                bits[row, i // 64] |= _ONE << np.uint64(i % 64)
+    return bits
+
+
+@njit(cache=True, fastmath=False)
+def _conflicts_cost(tt: np.ndarray, conflict_indptr: np.ndarray, conflict_indices: np.ndarray) -> int:
+    occupied = _pack_bits(tt)
+    courses, words = occupied.shape
+    cost = 0
+    for c1 in range(courses):
+        for c2 in conflict_indices[conflict_indptr[c1]:conflict_indptr[c1 + 1]]:
+            if c2 <= c1:
+                continue
+            for w in range(words):
+                cost += _popcount(occupied[c1, w] & occupied[c2, w])
+    return cost
+
+
+@lru_cache(maxsize=None)
+def _timetable_costs_kernel(periods_per_day: int, days: int):  # noqa: C901
+    """Build kernel for the soft costs that only need the timetable and per course data
+    Room capacity, min working days and room stability are accumulated in a
+    single sweep over the timetable, day and timeslot counts are closure
+    constants as in the other shape kernels
+    """
+    @njit(cache=True, fastmath=False)
+    def kernel(
+            tt: np.ndarray, students: np.ndarray, capacity: np.ndarray, min_working_days: np.ndarray, rooms: int,
+    ) -> Tuple[int, int, int]:
+        capacity_cost = working_days_cost = stability_cost = 0
+        used = np.zeros(rooms + 1, dtype=np.bool_)
+        for c in range(tt.shape[0]):
+            used[:] = False
+            working_days = used_rooms = 0
+            for d in range(days):
+                busy = False
+                for t in range(periods_per_day):
+                    p = d * periods_per_day + t
+                    r = tt[c, p]
+                    if not r:
+                        continue
+                    busy = True
+                    if capacity[r - 1] < students[c]:
+                        capacity_cost += students[c] - capacity[r - 1]
+                    if not used[r]:
+                        used[r] = True
+                        used_rooms += 1
+                if busy:
+                    working_days += 1
+            if working_days < min_working_days[c]:
+                working_days_cost += min_working_days[c] - working_days
+            if used_rooms > 1:
+                stability_cost += used_rooms - 1
+        return capacity_cost, working_days_cost, stability_cost
+
+    return kernel
+
+
+@lru_cache(maxsize=None)
+def _curriculum_compactness_kernel(periods_per_day: int, days: int):
+    """Build curriculum compactness cost kernel specialized for the faculty shape
+    Same closure constant trick as _timetable_costs_kernel, the padded
+    buffer size and all day offsets become literals
+    """
+    # One zero timeslot around every day, so neighbours need no day boundary checks
+    stride = periods_per_day + 2
+
+    @njit(cache=True, fastmath=False)
+    def kernel(tt: np.ndarray, curriculum_indptr: np.ndarray, curriculum_indices: np.ndarray) -> int:
+        cost = 0
+        lectures = np.zeros(days * stride, dtype=np.int32)
+        for g in range(curriculum_indptr.shape[0] - 1):
+            lectures[:] = 0
+            for c in curriculum_indices[curriculum_indptr[g]:curriculum_indptr[g + 1]]:
+                for d in range(days):
+                    for s in range(periods_per_day):
+                        if tt[c, d * periods_per_day + s]:
+                            lectures[d * stride + s + 1] += 1
+
+            for i in range(1, days * stride - 1):
+                cost += lectures[i] * ((lectures[i - 1] == 0) & (lectures[i + 1] == 0))
+        return cost
+
+    return kernel
+
+
+class FacultyData(NamedTuple):
+    lectures: np.ndarray
+    min_working_days: np.ndarray
+    students: np.ndarray
+    capacity: np.ndarray
+    # CSR curricula of each course
+    course_curricula_indptr: np.ndarray
+    course_curricula_indices: np.ndarray
+    # CSR conflicting courses of each course
+    conflict_indptr: np.ndarray
+    conflict_indices: np.ndarray
+    conflict_bits: np.ndarray  # (courses X course words) packed conflicts
+    availability: np.ndarray
+    availability_bits: np.ndarray  # (courses X words) packed availability
+    periods_per_day: int
+    min_working_days_cost: int
+    curriculum_compactness_cost: int
+    room_stability_cost: int
+
+
+class Counters(NamedTuple):
+    timetable: np.ndarray  # (courses X periods) room of each lecture
+    room_lectures: np.ndarray  # (rooms + 1 X periods)
+    curriculum_period_lectures: np.ndarray  # (curricula X periods)
+    course_daily_lectures: np.ndarray  # (courses X days)
+    course_room_lectures: np.ndarray  # (courses X rooms + 1)
+    occupied: np.ndarray  # (courses X words) packed periods with a lecture
+    scratch: np.ndarray  # (2 X words) period set buffers, reused by every lookup
+    period_courses: np.ndarray  # (periods X course words) packed courses with a lecture
+
+
+# Search loop kernels use numpy error model: divisors are the (positive)
+# periods per day and word size, so zero division checks are dead code
+@njit(cache=True, error_model='numpy')
+def _lecture_tables(
+        tt: np.ndarray,
+        course_curricula_indptr: np.ndarray,
+        course_curricula_indices: np.ndarray,
+        curricula: int,
+        rooms: int,
+        periods_per_day: int,
+):
+    """Get (room X period, curriculum X period, course X day, course X room) lecture counts"""
+    courses, periods = tt.shape
+    room_lectures = np.zeros((rooms + 1, periods), dtype=np.int32)
+    curriculum_period_lectures = np.zeros((curricula, periods), dtype=np.int32)
+    course_daily_lectures = np.zeros((courses, periods // periods_per_day), dtype=np.int32)
+    course_room_lectures = np.zeros((courses, rooms + 1), dtype=np.int32)
+    for c in range(courses):
+        for p in range(periods):
+            r = tt[c, p]
+            if not r:
+                continue
+            room_lectures[r, p] += 1
+            course_daily_lectures[c, p // periods_per_day] += 1
+            course_room_lectures[c, r] += 1
+            for g in course_curricula_indices[course_curricula_indptr[c]:course_curricula_indptr[c + 1]]:
+                curriculum_period_lectures[g, p] += 1
+    return room_lectures, curriculum_period_lectures, course_daily_lectures, course_room_lectures
+
+
+@njit(cache=True, error_model='numpy')
+def _build_counters(
+        tt: np.ndarray,
+        course_curricula_indptr: np.ndarray,
+        course_curricula_indices: np.ndarray,
+        curricula: int,
+        rooms: int,
+        periods_per_day: int,
+):
+    room_lectures, curriculum_period_lectures, course_daily_lectures, course_room_lectures = _lecture_tables(
+        tt, course_curricula_indptr, course_curricula_indices, curricula, rooms, periods_per_day,
+    )
+    occupied = _pack_bits(tt)
+    scratch = np.zeros((2, occupied.shape[1]), dtype=np.uint64)
+    period_courses = _pack_bits(tt.T)
+    return (
+        room_lectures, curriculum_period_lectures, course_daily_lectures, course_room_lectures,
+        occupied, scratch, period_courses,
+    )
+
+
+@njit(cache=True, error_model='numpy')
+def _isolated_lectures(lectures: np.ndarray, p: int, periods_per_day: int) -> int:
+    if p < 0 or p >= lectures.shape[0] or not lectures[p]:
+        return 0
+    if p % periods_per_day and lectures[p - 1]:
+        return 0
+    if (p + 1) % periods_per_day and lectures[p + 1]:
+        return 0
+    return lectures[p]
+
+
+@njit(cache=True, error_model='numpy')
+def _toggle_lecture(counters: Counters, data: FacultyData, c: int, p: int, r: int, add: bool):  # noqa: C901
+    """Add (or remove) lecture of course c in room r at period p, return (violations, soft) cost change"""
+    tt, occupied, period_courses = counters.timetable, counters.occupied, counters.period_courses
+    room_lectures, course_room_lectures = counters.room_lectures, counters.course_room_lectures
+    curriculum_period_lectures = counters.curriculum_period_lectures
+    course_daily_lectures = counters.course_daily_lectures
+    ppd = data.periods_per_day
+    sign = 1 if add else -1
+    violations, soft = 0, 0
+
+    # Lectures
+    lectures = course_daily_lectures[c].sum()
+    violations += abs(lectures + sign - data.lectures[c]) - abs(lectures - data.lectures[c])
+    # Conflicts, conflicting courses with a lecture at p
+    for w in range(period_courses.shape[1]):
+        violations += sign * _popcount(data.conflict_bits[c, w] & period_courses[p, w])
+    # Availability
+    if not data.availability[c, p]:
+        violations += sign
+    # RoomOccupation
+    occupation = room_lectures[r, p]
+    violations += max(occupation + sign - 1, 0) - max(occupation - 1, 0)
+    room_lectures[r, p] += sign
+    # RoomCapacity
+    if data.capacity[r - 1] < data.students[c]:
+        soft += sign * (data.students[c] - data.capacity[r - 1])
+    # MinWorkingDays
+    working_days = 0
+    for daily in course_daily_lectures[c]:
+        if daily:
+            working_days += 1
+    before = max(data.min_working_days[c] - working_days, 0)
+    daily_before = course_daily_lectures[c, p // ppd]
+    course_daily_lectures[c, p // ppd] += sign
+    if not daily_before:
+        working_days += 1
+    elif not course_daily_lectures[c, p // ppd]:
+        working_days -= 1
+    soft += (max(data.min_working_days[c] - working_days, 0) - before) * data.min_working_days_cost
+    # RoomStability
+    used_rooms = 0
+    for room_count in course_room_lectures[c, 1:]:
+        if room_count:
+            used_rooms += 1
+    before = max(used_rooms - 1, 0)
+    rooms_before = course_room_lectures[c, r]
+    course_room_lectures[c, r] += sign
+    if not rooms_before:
+        used_rooms += 1
+    elif not course_room_lectures[c, r]:
+        used_rooms -= 1
+    soft += (max(used_rooms - 1, 0) - before) * data.room_stability_cost
+    # CurriculumCompactness
+    for g in data.course_curricula_indices[data.course_curricula_indptr[c]:data.course_curricula_indptr[c + 1]]:
+        row = curriculum_period_lectures[g]
+        before = 0
+        for q in range(p - 1, p + 2):
+            before += _isolated_lectures(row, q, ppd)
+        row[p] += sign
+        after = 0
+        for q in range(p - 1, p + 2):
+            after += _isolated_lectures(row, q, ppd)
+        soft += (after - before) * data.curriculum_compactness_cost
+
+    tt[c, p] = r if add else 0
+    bit, course_bit = _ONE << np.uint64(p % 64), _ONE << np.uint64(c % 64)
+    if add:
+        occupied[c, p // 64] |= bit
+        period_courses[p, c // 64] |= course_bit
+    else:
+        occupied[c, p // 64] &= ~bit
+        period_courses[p, c // 64] &= ~course_bit
+    return violations, soft
+
+
+@njit(cache=True, error_model='numpy')
+def _apply_moves(counters: Counters, data: FacultyData, moves: np.ndarray, commit: bool):
+    """Apply (course, old period, new period, old room, new room) moves, return (violations, soft) cost change"""
+    violations, soft = 0, 0
+    for i in range(moves.shape[0]):
+        c, old_p, new_p, old_r, new_r = moves[i]
+        v, s = _toggle_lecture(counters, data, c, old_p, old_r, False)
+        violations, soft = violations + v, soft + s
+        v, s = _toggle_lecture(counters, data, c, new_p, new_r, True)
+        violations, soft = violations + v, soft + s
+
+    if not commit:
+        _revert_moves(counters, data, moves)
+    return violations, soft
+
+
+@njit(cache=True, error_model='numpy')
+def _revert_moves(counters: Counters, data: FacultyData, moves: np.ndarray):
+    for i in range(moves.shape[0] - 1, -1, -1):
+        c, old_p, new_p, old_r, new_r = moves[i]
+        _toggle_lecture(counters, data, c, new_p, new_r, False)
+        _toggle_lecture(counters, data, c, old_p, old_r, True)
+
+
+@njit(cache=True, error_model='numpy')
+def _random_option(cumulative_weights: np.ndarray, rng) -> int:
+    roll = rng.integers(0, cumulative_weights[-1])
+    return np.searchsorted(cumulative_weights, roll, side='right')
+
+
+@njit(cache=True, error_model='numpy')
+def _pick_course_period_room(counters: Counters, rng, bad_course: int):
+    occupied = counters.occupied
+    courses, words = occupied.shape
+    if bad_course < 0:
+        c = rng.integers(0, courses)
+    else:
+        c = rng.integers(0, courses - 1)
+        if c >= bad_course:
+            c += 1
+    lectures = counters.course_daily_lectures[c].sum()
+    if not lectures:
+        raise ValueError('Course without lectures')
+    i = rng.integers(0, lectures)
+
+    # Unrank the i-th lecture from the occupancy words instead of scanning the row
+    for w in range(words):
+        count = _popcount(occupied[c, w])
+        if i < count:
+            p = w * 64 + _nth_bit(occupied[c, w], i)
+            return c, p, counters.timetable[c, p]
+        i -= count
+    raise ValueError('Missing lecture')
+
+
+@njit(cache=True, error_model='numpy')
+def _get_free_period(counters: Counters, data: FacultyData, rng, c: int, from_p: int) -> int:
+    """Get random accessible period for course, -1 if there is none
+    Periods where the course already has a lecture, from_p and unavailable
+    periods are skipped; periods taken by conflicting courses are skipped
+    too, unless fewer than two conflict free candidates would remain
+    """
+    occupied = counters.occupied
+    words = occupied.shape[1]
+    # Word loops write into preallocated buffers, array expressions would allocate on each call
+    candidates, free = counters.scratch[0], counters.scratch[1]
+    for w in range(words):
+        candidates[w] = data.availability_bits[c, w] & ~occupied[c, w]
+    if from_p >= 0:
+        candidates[from_p // 64] &= ~(_ONE << np.uint64(from_p % 64))
+    free[:] = candidates
+    for other in data.conflict_indices[data.conflict_indptr[c]:data.conflict_indptr[c + 1]]:
+        for w in range(words):
+            free[w] &= ~occupied[other, w]
+
+    available_count, free_count = 0, 0
+    for w in range(words):
+        available_count += _popcount(candidates[w])
+        free_count += _popcount(free[w])
+    if free_count >= 2:
+        i = rng.integers(0, free_count)
+    elif available_count:
+        free, i = candidates, rng.integers(0, available_count)
+    else:
+        return -1
+
+    for w in range(words):
+        count = _popcount(free[w])
+        if i < count:
+            return w * 64 + _nth_bit(free[w], i)
+        i -= count
+    return -1
+
+
+@njit(cache=True, error_model='numpy')
+def _get_free_room(rng, rooms: int, from_r: int) -> int:
+    if rooms < 2:
+        return from_r
+    r = rng.integers(1, rooms)
+    if r >= from_r:
+        r += 1
+    return r
+
+
+@njit(cache=True, error_model='numpy')
+def _set_move(move: np.ndarray, c: int, old_p: int, new_p: int, old_r: int, new_r: int):
+    move[0], move[1], move[2], move[3], move[4] = c, old_p, new_p, old_r, new_r
+
+
+@njit(cache=True, error_model='numpy')
+def _propose_moves(counters: Counters, data: FacultyData, rng, mutation: int, moves: np.ndarray) -> int:
+    """Write moves of the mutation (see solver.Mutation order) into moves buffer, return their number"""
+    rooms = counters.room_lectures.shape[0] - 1
+    tt = counters.timetable
+    c, p, room = _pick_course_period_room(counters, rng, -1)
+    if mutation == 0:  # change_room
+        _set_move(moves[0], c, p, p, room, _get_free_room(rng, rooms, room))
+        return 1
+    if mutation <= 2:  # change_period, change_both
+        new_p = _get_free_period(counters, data, rng, c, p)
+        if new_p < 0:
+            return 0
+        new_room = room if mutation == 1 else _get_free_room(rng, rooms, room)
+        _set_move(moves[0], c, p, new_p, room, new_room)
+        return 1
+
+    to_c, to_p, to_room = _pick_course_period_room(counters, rng, c)
+    if mutation == 3:  # swap_room
+        _set_move(moves[0], c, p, p, room, to_room)
+        _set_move(moves[1], to_c, to_p, to_p, to_room, room)
+        return 2
+    if tt[c, to_p] or tt[to_c, p]:
+        # Cannot swap this pair
+        return 0
+    if mutation == 4:  # swap_period
+        _set_move(moves[0], c, p, to_p, room, room)
+        _set_move(moves[1], to_c, to_p, p, to_room, to_room)
+    else:  # swap_both
+        _set_move(moves[0], c, p, to_p, room, to_room)
+        _set_move(moves[1], to_c, to_p, p, to_room, room)
+    return 2
+
+
+@njit(cache=True, error_model='numpy')
+def _run_shot(
+        counters: Counters,
+        data: FacultyData,
+        rng,
+        mutation_count_chances: np.ndarray,  # cumulative
+        mutation_chances: np.ndarray,  # cumulative
+        iterations: int,
+        max_consecutive_rejects: int,
+        violation_cost: int,
+        cost: int,
+        temperature: float,
+        cooling_rate: float,
+):
+    """Simulated annealing over counters.timetable in place
+    Return (best cost, best timetable, last iteration, approves); with
+    zero temperature worse solutions are accepted with flat 1% chance,
+    otherwise by Metropolis criterion cooled by cooling_rate each iteration
+    """
+    moves = np.zeros((2 * (mutation_count_chances.shape[0] - 1), 5), dtype=np.int64)
+    # Acceptance rolls for the whole shot at once
+    rolls = rng.random(iterations)
+    metropolis = temperature > 0
+    best_cost, best = cost, counters.timetable.copy()
+
+    i, approves, rejects = 0, 0, 0
+    for i in range(iterations):
+        if rejects > max_consecutive_rejects:
+            break
+
+        # Moves are committed right away so following mutations see them, and reverted on reject
+        count, violations, soft = 0, 0, 0
+        for _ in range(_random_option(mutation_count_chances, rng)):
+            mutation = _random_option(mutation_chances, rng)
+            added = _propose_moves(counters, data, rng, mutation, moves[count:])
+            v, s = _apply_moves(counters, data, moves[count:count + added], True)
+            count, violations, soft = count + added, violations + v, soft + s
+        new_cost = cost + violations * violation_cost + soft
+
+        threshold = 0.01
+        if metropolis:
+            threshold = np.exp(min(cost - new_cost, 0) / temperature)
+            # Floored so the division stays finite after long cooling
+            temperature = max(temperature * cooling_rate, 1e-9)
+        # Bitwise or evaluates both cheap comparisons, leaving one branch instead of two
+        if (new_cost < cost) | (rolls[i] < threshold):
+            rejects = 0
+            approves += 1
+            cost = new_cost
+            if cost < best_cost:
+                best_cost = cost
+                best[:] = counters.timetable
+        else:
+            rejects += 1
+            _revert_moves(counters, data, moves[:count])
+    return best_cost, best, i, approves
@@ -1,38 +1,72 @@
 import logging
+import multiprocessing
+import multiprocessing.util
+import pickle
 import random
 import sys
-from concurrent.futures import ProcessPoolExecutor
-from dataclasses import dataclass
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, replace
 from enum import Enum
-from heapq import nsmallest
-from itertools import cycle, islice
-from operator import itemgetter
-from typing import Any, Mapping, Optional, Sequence, Tuple
+from multiprocessing import shared_memory
+from typing import Optional, Sequence, Tuple, Union
 
 import click
+import numpy as np
 
+from ._kernels import _run_shot
 from .settings import MAX_WORKERS
 from .structures import Faculty, Timetable
 from .validator import Validator
 
 logger = logging.getLogger(__name__)
 
+# Per-process solver, set once by the pool initializer instead of pickling it with every shot
+_worker_solver: Optional['Solver'] = None
+# Per-process view of the shared grids block, see Solver.grids_shape
+_worker_memory: Optional[shared_memory.SharedMemory] = None
+_worker_grids: Optional[np.ndarray] = None
 
-def get_random_option(option_chances: Mapping[Any, int]) -> Any:
-    return random.choice([
-        count
-        for count, chances in option_chances.items()
-        for _ in range(chances)
-    ])
+# Shot results are (cost, timetable matrix), without faculty and redundant data
+ShotResult = Tuple[int, np.ndarray]
+
+
+def _worker_init(solver: Union['Solver', bytes], memory_name: str):
+    global _worker_solver, _worker_memory, _worker_grids
+    _worker_solver = pickle.loads(solver) if isinstance(solver, bytes) else solver
+    _worker_memory = shared_memory.SharedMemory(name=memory_name)
+    _worker_grids = np.ndarray(_worker_solver.grids_shape, dtype=np.int16, buffer=_worker_memory.buf)
+    # Only the parent unlinks the block, workers just drop their mapping on exit. Finalizers run on
+    # worker exit with both start methods, atexit hooks are skipped by forked children
+    multiprocessing.util.Finalize(None, _worker_close, exitpriority=0)
+
+
+def _worker_close():
+    global _worker_memory, _worker_grids
+    # The grids view holds an export of the buffer, it has to go before close
+    _worker_grids = None
+    if _worker_memory is not None:
+        _worker_memory.close()
+        _worker_memory = None
+
+
+def _worker_shot(cost: Optional[int], slot: int, from_grid: bool, seed: np.random.SeedSequence) -> int:
+    """Shoot from input grid of the slot (or from init), store result in the output grid of the slot, return cost"""
+    if _worker_solver is None or _worker_grids is None:
+        raise RuntimeError('Solver worker is not initialized')
+    grid = _worker_grids[0, slot].copy() if from_grid else None
+    cost, result = _worker_solver.shot(cost, grid, seed)
+    _worker_grids[1, slot] = result
+    return cost
 
 
 class Mutation(Enum):
+    # Order matters, the shot kernel dispatches on the member index
     change_room = 'change_room'
     change_period = 'change_period'
-    change_both = 'change_period'
+    change_both = 'change_both'
     swap_room = 'swap_room'
     swap_period = 'swap_period'
-    swap_both = 'swap_period'
+    swap_both = 'swap_both'
 
 
 @dataclass
@@ -51,6 +85,10 @@ class Solver:
     sort_courses: bool
     repeat_sliced_results: bool
 
+    # annealing schedule, zero temperature keeps flat 1% acceptance of worse results
+    temperature: float = 0.0
+    cooling_rate: float = 1.0
+
     mutation_count_chances = {  # TODO Tune
         1: 1,
         # 2: 2,
@@ -68,263 +106,187 @@ class Solver:
         # Mutation.swap_both: 1,
     }
 
+    @property
+    def course_order(self) -> np.ndarray:
+        """Courses in init order, rebuilt on each init so sort_courses changes are picked up"""
+        courses = np.arange(self.faculty.courses)
+        # Shown no effect on results(
+        if self.sort_courses:
+            weights = np.array(self.faculty.course_conflict_weights)
+            courses = np.argsort(-weights, kind='stable')
+        return courses
+
+    @property
+    def cumulative_chances(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Get cumulative (mutation count, mutation) weights, indexed by count and Mutation member index
+        Rebuilt on every shot (a few tiny arrays), so changes to the chances
+        on the instance are always picked up
+        """
+        mutation_count_chances = np.zeros(max(self.mutation_count_chances) + 1, dtype=np.int64)
+        for count, chances in self.mutation_count_chances.items():
+            mutation_count_chances[count] = chances
+        mutation_chances = np.array([self.mutation_chances.get(m, 0) for m in Mutation], dtype=np.int64)
+        return np.cumsum(mutation_count_chances), np.cumsum(mutation_chances)
+
+    @property
+    def grids_shape(self) -> Tuple[int, int, int, int]:
+        # (input / output X shots X courses X periods)
+        return 2, self.shots, self.faculty.courses, self.faculty.periods
+
     def do_the_thing(self, init_timetable: Optional[Timetable] = None) -> Tuple[int, Timetable]:
-        random.seed(self.seed)
-        init_timetables = [(None, init_timetable) for _ in range(self.shots)]
-        timetables = self.shot_timetables(init_timetables)
-        logger.info(
-            'Got %d timetables, cost range - [%d, %d]',
-            self.shots,
-            min(timetables, key=itemgetter(0))[0],
-            max(timetables, key=itemgetter(0))[0],
+        seed_sequence = np.random.SeedSequence(self.seed)
+        worker_solver: Union[Solver, bytes] = self
+        # Default (platform or user chosen) start method is kept, forking is unsafe e.g. on macOS.
+        # Forked workers inherit the solver memory, others get it pickled once here and only unpickle the bytes
+        if multiprocessing.get_start_method() != 'fork':
+            worker_solver = pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # Grids are exchanged through shared memory, tasks and results only carry costs and slots
+        memory = shared_memory.SharedMemory(
+            create=True, size=int(np.prod(self.grids_shape)) * np.dtype(np.int16).itemsize,
         )
+        try:
+            with ProcessPoolExecutor(
+                    max_workers=MAX_WORKERS,
+                    initializer=_worker_init,
+                    initargs=(worker_solver, memory.name),
+            ) as executor:
+                cost, grid = self.shoot_slices(executor, seed_sequence, memory, init_timetable)
+        finally:
+            memory.close()
+            memory.unlink()
+        return cost, Timetable.from_grid(self.faculty, grid)
+
+    def shoot_slices(
+            self,
+            executor: Executor,
+            seed_sequence: np.random.SeedSequence,
+            memory: shared_memory.SharedMemory,
+            init_timetable: Optional[Timetable],
+    ) -> ShotResult:
+        grids = np.ndarray(self.grids_shape, dtype=np.int16, buffer=memory.buf)
+        from_grid = init_timetable is not None
+        if init_timetable is not None:
+            grids[0] = init_timetable.timetable
+        costs = self.shot_timetables(executor, seed_sequence, [None] * self.shots, from_grid)
+        logger.info('Got %d timetables, cost range - [%d, %d]', self.shots, costs.min(), costs.max())
 
         for _ in range(self.slices):
-            top = int(len(timetables) * self.slice_ratio)
+            # Ratio above 1 keeps every timetable, argpartition needs kth within bounds
+            top = min(int(len(costs) * self.slice_ratio), len(costs))
             if not top:
                 break
 
-            timetables = list(nsmallest(top, timetables, key=itemgetter(0)))
+            selected = np.argpartition(costs, top - 1)[:top]
             logger.info(
                 'Selected %d top timetables, cost range - [%d, %d]',
                 top,
-                min(timetables, key=itemgetter(0))[0],
-                max(timetables, key=itemgetter(0))[0],
+                costs[selected].min(),
+                costs[selected].max(),
             )
             if self.repeat_sliced_results:
-                timetables = list(islice(cycle(timetables), self.shots))
-            timetables = self.shot_timetables(timetables)
+                selected = selected[np.arange(self.shots) % top]
+            grids[0, :len(selected)] = grids[1, selected]
+            costs = self.shot_timetables(executor, seed_sequence, costs[selected].tolist(), True)
 
-        return min(timetables, key=itemgetter(0))
+        best = int(costs.argmin())
+        return int(costs[best]), grids[1, best].copy()
 
     def shot_timetables(
-            self, timetables: Sequence[Tuple[Optional[int], Optional[Timetable]]],
-    ) -> Sequence[Tuple[int, Timetable]]:
-        with ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            # *zip(* is starmap replacement
-            return list(executor.map(
-                self.shot,
-                *zip(*timetables),
-                (random.randrange(sys.maxsize) for _ in range(self.shots)),  # inner seed
-            ))
-
-    def shot(
-            self, cost: Optional[int], timetable: Optional[Timetable], seed: int,
-    ) -> Tuple[int, Timetable]:
-        random.seed(seed)
-        if timetable is None:
-            timetable = self.init()
+            self,
+            executor: Executor,
+            seed_sequence: np.random.SeedSequence,
+            costs: Sequence[Optional[int]],
+            from_grid: bool,
+    ) -> np.ndarray:
+        """Shoot from the first len(costs) input grids (or from init), return resulting costs"""
+        return np.fromiter(executor.map(
+            _worker_shot,
+            costs,
+            range(len(costs)),
+            [from_grid] * len(costs),
+            seed_sequence.spawn(len(costs)),  # inner seed
+            chunksize=max(1, len(costs) // (MAX_WORKERS * 4)),
+        ), dtype=np.int64, count=len(costs))
+
+    def shot(self, cost: Optional[int], grid: Optional[np.ndarray], seed: np.random.SeedSequence) -> ShotResult:
+        rng = np.random.default_rng(seed)
+        if grid is None:
+            timetable = self.init(rng)
+        else:
+            timetable = Timetable.from_grid(self.faculty, grid)
         if cost is None:
             cost = self.evaluate(timetable)
 
-        i, approves, rejects = 0, 0, 0
-        for i in range(self.iterations):
-            if rejects > self.max_consecutive_rejects:
-                break
-            new_timetable = self.iterate(timetable)
-            if new_timetable == timetable:
-                new_cost = cost
-            else:
-                new_cost = self.evaluate(new_timetable)
-
-            if self.should_accept(cost, new_cost):
-                rejects = 0
-                approves += 1
-                cost, timetable = new_cost, new_timetable
-            else:
-                rejects += 1
-
-        logger.debug(f'Finished shot on iteration #{i} after {approves} approves with score {cost}')
-        return cost, timetable
-
-    @staticmethod
-    def should_accept(old_cost: int, new_cost: int) -> bool:
-        return new_cost < old_cost or random.random() < 0.01
+        # Counters work on their own copy of the timetable matrix
+        counters = Validator(self.faculty, timetable).counters
+        mutation_count_chances, mutation_chances = self.cumulative_chances
+
+        cost, grid, i, approves = _run_shot(
+            counters,
+            self.faculty.data,
+            rng,
+            mutation_count_chances,
+            mutation_chances,
+            self.iterations,
+            self.max_consecutive_rejects,
+            self.violation_cost,
+            cost,
+            self.temperature,
+            self.cooling_rate,
+        )
+
+        logger.debug('Finished shot on iteration #%d after %d approves with score %d', i, approves, cost)
+        return int(cost), grid
+
+    def warm_up(self):
+        """Run a single iteration shot so kernels are compiled before the pool starts
+        Forked workers inherit compiled kernels, others load them from the disk cache
+        """
+        replace(self, iterations=1).shot(None, None, np.random.SeedSequence(self.seed))
 
     def evaluate(self, timetable: Timetable):
         validator = Validator(self.faculty, timetable)
         return validator.total_violation_cost * self.violation_cost + validator.total_soft_cost
 
-    def init(self) -> Timetable:  # TODO
+    def init(self, rng: np.random.Generator) -> Timetable:  # TODO
         timetable = Timetable.from_faculty(self.faculty)
-
-        courses = list(range(self.faculty.courses))
-        # Shown no effect on results(
-        if self.sort_courses:
-            courses.sort(key=lambda c: -self.faculty.course_conflict_weights[c])
-        for c in courses:
-            for i in range(self.faculty.course_vect[c].lectures):
-                p = self.get_free_period(timetable, c)
-                room = self.get_free_room(timetable, c, p)
-                timetable.timetable[c][p] = room
-
-        timetable.update_redundant_data()
-        return timetable
-
-    def iterate(self, timetable: Timetable) -> Timetable:  # TODO
-        mutate = {
-            Mutation.change_room: self.mutate_change_room,
-            Mutation.change_period: self.mutate_change_period,
-            Mutation.change_both: self.mutate_change_both,
-            Mutation.swap_room: self.mutate_swap_room,
-            Mutation.swap_period: self.mutate_swap_period,
-            Mutation.swap_both: self.mutate_swap_both,
-        }
-
-        timetable = timetable.clone()
-
-        mutations_count = get_random_option(self.mutation_count_chances)
-        for _ in range(mutations_count):
-            mutation = get_random_option(self.mutation_chances)
-            timetable = mutate[mutation](timetable)
+        tt = timetable.timetable
+
+        for c in self.course_order:
+            lectures = self.faculty.lectures_np[c]
+            available = self.faculty.availability_np[c]
+            conflicting = (tt[self.faculty.conflict_mask(c)] != 0).any(axis=0)
+            # Prefer periods free of conflicts, then available ones, then any other
+            periods = np.concatenate([
+                rng.permutation(np.flatnonzero(available & ~conflicting)),
+                rng.permutation(np.flatnonzero(available & conflicting)),
+                rng.permutation(np.flatnonzero(~available)),
+            ])
+            # More lectures than periods (infeasible, but valid input) fill every period
+            periods = periods[:lectures]
+            tt[c, periods] = rng.integers(1, self.faculty.rooms + 1, size=len(periods))
 
         timetable.update_redundant_data()
         return timetable
 
-    def mutate_change_room(self, timetable: Timetable) -> Timetable:
-        c, p, room = self.pick_course_period_room(timetable)
-        # Change the room of the lecture
-        new_room = self.get_free_room(timetable, c, p, room)
-        timetable.timetable[c][p] = new_room
-        return timetable
-
-    def mutate_change_period(self, timetable: Timetable) -> Timetable:
-        c, p, room = self.pick_course_period_room(timetable)
-        # change the period of the lecture
-        new_p = self.get_free_period(timetable, c, p)
-        timetable.timetable[c][new_p] = timetable.timetable[c][p]
-        timetable.timetable[c][p] = 0
-        return timetable
-
-    def mutate_change_both(self, timetable: Timetable) -> Timetable:
-        c, p, room = self.pick_course_period_room(timetable)
-        # change the period of the lecture
-        new_p = self.get_free_period(timetable, c, p)
-        new_room = self.get_free_room(timetable, c, new_p, room)
-        timetable.timetable[c][new_p] = new_room
-        timetable.timetable[c][p] = 0
-        return timetable
-
-    def mutate_swap_room(self, timetable: Timetable) -> Timetable:
-        from_c, from_p, from_room = self.pick_course_period_room(timetable)
-        to_c, to_p, to_room = self.pick_course_period_room(timetable, bad_course=from_c)
-        timetable.timetable[from_c][from_p] = to_room
-        timetable.timetable[to_c][to_p] = from_room
-        return timetable
-
-    def mutate_swap_period(self, timetable: Timetable) -> Timetable:
-        from_c, from_p, from_room = self.pick_course_period_room(timetable)
-        to_c, to_p, to_room = self.pick_course_period_room(timetable, bad_course=from_c)
-        if timetable.timetable[from_c][to_p] or timetable.timetable[to_c][from_p]:
-            # Cannot swap this pair
-            return timetable
-
-        timetable.timetable[from_c][from_p] = 0
-        timetable.timetable[from_c][to_p] = from_room
-        timetable.timetable[to_c][to_p] = 0
-        timetable.timetable[to_c][from_p] = to_room
-        return timetable
-
-    def mutate_swap_both(self, timetable: Timetable) -> Timetable:
-        from_c, from_p, from_room = self.pick_course_period_room(timetable)
-        to_c, to_p, to_room = self.pick_course_period_room(timetable, bad_course=from_c)
-        if timetable.timetable[from_c][to_p] or timetable.timetable[to_c][from_p]:
-            # Cannot swap this pair
-            return timetable
-
-        timetable.timetable[from_c][from_p] = 0
-        timetable.timetable[from_c][to_p] = to_room
-        timetable.timetable[to_c][to_p] = 0
-        timetable.timetable[to_c][from_p] = from_room
-        return timetable
-
-    def pick_course_period_room(self, timetable: Timetable, bad_course: Optional[int] = None) -> Tuple[int, int, int]:
-        courses = set(range(self.faculty.courses))
-        if bad_course is not None:
-            courses.discard(bad_course)
-        c = random.choice(tuple(courses))
-        i = random.randrange(self.faculty.course_vect[c].lectures)
-
-        for p in range(self.faculty.periods):
-            room = timetable.timetable[c][p]
-            if not room:
-                continue
-            if i:
-                i -= 1
-                continue
-            return c, p, room
-        raise ValueError('Missing lecture #%d for course %s', i + 1, self.faculty.course_vect[c].name)
-
-    def get_free_period(self, timetable: Timetable, c: int, from_p: Optional[int] = None) -> int:
-        """Get random accessible period for course in timetable
-        Takes into account:
-        1) Specified course must not already take place on such period
-        2) If from_p passed, this value is forbidden too
-        3) Take into account forbidden periods
-        4) Courses from same curricula / teacher must not take place on such period
-        """
-        periods = set(range(self.faculty.periods))
-        # 1) Specified course must not already take place on such period
-        same_possible_periods = periods.copy()
-        for p in periods:
-            if timetable.timetable[c][p]:
-                same_possible_periods.discard(p)
-
-        # 2) If from_p passed, this value is forbidden too
-        from_possible_periods = same_possible_periods.copy()
-        if from_p is not None:
-            from_possible_periods.discard(from_p)
-
-        # 3) Take into account forbidden periods
-        available_periods = from_possible_periods.copy()
-        for p in from_possible_periods:
-            if not self.faculty.availability[c][p]:
-                available_periods.discard(p)
-
-        # 4) Courses from same curricula / teacher must not take place on such period
-        conflict_periods = available_periods.copy()
-        for conflict_course in self.faculty.conflict[c]:
-            for p in available_periods:
-                if timetable.timetable[conflict_course][p]:
-                    conflict_periods.discard(p)
-
-        if len(conflict_periods) < 2:
-            logger.debug(
-                'Only %d possible periods for course %s, skipping conflict validation',
-                len(conflict_periods), self.faculty.course_vect[c].name,
-            )
-            return random.choice(tuple(available_periods))
-
-        return random.choice(tuple(conflict_periods))
-
-    def get_free_room(self, timetable: Timetable, c: int, p: int, from_r: Optional[int] = None) -> int:
-        rooms = set(range(1, self.faculty.rooms + 1))
-        # If from_r passed, this value is forbidden
-        from_rooms = rooms.copy()
-        if from_r is not None:
-            from_rooms.discard(from_r)
-
-        return random.choice(tuple(from_rooms))
-
 
 def make_solver(faculty_input, violation_cost, seed, **kwargs) -> Solver:
     faculty = Faculty.from_stream(faculty_input)
     if violation_cost is None:
-        violation_cost = sum(
-            faculty.course_vect[c].lectures
-            for c in range(faculty.courses)
-        ) * 100
+        violation_cost = int(faculty.lectures_np.sum()) * 100
         logger.info('Validation cost ratio is set to %d', violation_cost)
     if seed is None:
         seed = random.randrange(sys.maxsize)
         logger.info('Seed is set to %d', seed)
 
-    return Solver(
+    solver = Solver(
         faculty=faculty,
         violation_cost=violation_cost,
         seed=seed,
         **kwargs,
     )
+    return solver
 
 
 @click.command()
@@ -344,6 +306,14 @@ def make_solver(faculty_input, violation_cost, seed, **kwargs) -> Solver:
 @click.option('--max-consecutive-rejects', type=int, default=20, show_default=True)
 @click.option('--sort-courses', type=bool, default=True, show_default=True)
 @click.option('--repeat-sliced-results', type=bool, default=True, show_default=True)
+@click.option(
+    '--temperature', type=float, default=0.0, show_default=True,
+    help='Initial Metropolis temperature, 0 accepts worse results with flat 1% chance',
+)
+@click.option(
+    '--cooling-rate', type=float, default=1.0, show_default=True,
+    help='Temperature multiplier per iteration',
+)
 def main(faculty, output, from_solution, log_level, **solver_kwargs):
     logging.basicConfig(
         format='%(asctime)s - [%(levelname)s] - [%(name)s] - %(filename)s:%(lineno)d - %(message)s',
@@ -353,6 +323,7 @@ def main(faculty, output, from_solution, log_level, **solver_kwargs):
     if from_solution:
         from_solution = Timetable.from_stream(solver.faculty, from_solution)
 
+    solver.warm_up()
     score, timetable = solver.do_the_thing(from_solution)
     logger.info('Best score is %d', score)
 
@@ -1,9 +1,13 @@
 import logging
 from collections import defaultdict
-from copy import deepcopy
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+from functools import cached_property
 from itertools import combinations
-from typing import IO, List, Set
+from typing import IO, Dict, FrozenSet, Iterator, List, Tuple
+
+import numpy as np
+
+from ._kernels import FacultyData, _lecture_tables, _pack_bits
 
 logger = logging.getLogger(__name__)
 
@@ -16,8 +20,17 @@ __all__ = (
 )
 
 
+def _csr(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Get (indptr, indices) int32 compressed rows of boolean matrix"""
+    indptr = np.zeros(matrix.shape[0] + 1, dtype=np.int32)
+    np.cumsum(matrix.sum(axis=1), out=indptr[1:])
+    return indptr, np.nonzero(matrix)[1].astype(np.int32)
+
+
 @dataclass
 class Course:
+    __slots__ = ('name', 'teacher', 'students', 'lectures', 'min_working_days')
+
     name: str
     teacher: str
     students: int
@@ -25,8 +38,8 @@ class Course:
     min_working_days: int
 
     @classmethod
-    def from_buffer(cls, buffer: IO):
-        name, teacher, lectures, min_working_days, students = next(buffer).split()
+    def from_tokens(cls, tokens: Iterator[str]):
+        name, teacher, lectures, min_working_days, students = (next(tokens) for _ in range(5))
         return cls(
             name=name,
             teacher=teacher,
@@ -38,31 +51,36 @@ class Course:
 
 @dataclass
 class Curriculum:
+    __slots__ = ('name', 'members')
+
     name: str
-    members: List[Course]  # ?
+    members: List[str]  # course names
 
     @property
     def size(self):
         return len(self.members)
 
     @classmethod
-    def from_buffer(cls, buffer: IO):
-        name, _, *members = next(buffer).split()
-        return cls(name=name, members=members)
+    def from_tokens(cls, tokens: Iterator[str]):
+        name, size = next(tokens), int(next(tokens))
+        return cls(name=name, members=[next(tokens) for _ in range(size)])
 
 
 @dataclass
 class Room:
+    __slots__ = ('name', 'capacity')
+
     name: str
     capacity: int
 
     @classmethod
-    def from_buffer(cls, buffer: IO):
-        name, capacity = next(buffer).split()
+    def from_tokens(cls, tokens: Iterator[str]):
+        name, capacity = next(tokens), next(tokens)
         return cls(name=name, capacity=int(capacity))
 
 
-@dataclass
+# Identity equality and hashing, timetables already compare faculties with `is`
+@dataclass(eq=False)
 class Faculty:
     name: str
     rooms: int
@@ -75,14 +93,32 @@ class Faculty:
     room_vect: List[Room]
     curricula_vect: List[Curriculum]
 
-    availability: List[List[bool]]  # defaults to true
-    conflict: List[Set[int]]  # defaults to false
-
     # Added
-    no_availability_py: defaultdict
+    no_availability_py: FrozenSet[Tuple[str, int]]  # (course name, period) pairs
     course_names: List[str]
+    course_index: Dict[str, int]
+    room_names: List[str]  # room r of the timetable is room_names[r - 1]
+    room_index: Dict[str, int]  # room numbers as in timetable, starting from 1
     course_conflict_weights: List[int]
 
+    # Flat arrays for the cost kernels
+    lectures_np: np.ndarray  # (courses,) int32
+    min_working_days_np: np.ndarray  # (courses,) int32
+    students_np: np.ndarray  # (courses,) int32
+    capacity_np: np.ndarray  # (rooms,) int32
+    curriculum_indptr_np: np.ndarray  # (curricula + 1,) int32
+    curriculum_indices_np: np.ndarray  # (curricula members,) int32 courses
+    course_curricula_indptr_np: np.ndarray  # (courses + 1,) int32
+    course_curricula_indices_np: np.ndarray  # (curricula members,) int32 curricula
+    conflict_np: np.ndarray  # (courses X courses) bool
+    conflict_indptr_np: np.ndarray  # (courses + 1,) int32
+    conflict_indices_np: np.ndarray  # (conflicting pairs * 2,) int32 courses
+    conflict_bits_np: np.ndarray  # (courses X ceil(courses / 64)) uint64, bit c2 % 64 of word c2 // 64
+    availability_np: np.ndarray  # (courses X periods) bool, defaults to true
+    availability_bits_np: np.ndarray  # (courses X ceil(periods / 64)) uint64, bit p % 64 of word p // 64
+    day_of_np: np.ndarray  # (periods,) int32 day of each period
+    timeslot_of_np: np.ndarray  # (periods,) int32 timeslot of each period within its day
+
     MIN_WORKING_DAYS_COST: int = 5
     CURRICULUM_COMPACTNESS_COST: int = 2
     ROOM_STABILITY_COST: int = 1
@@ -91,64 +127,92 @@ class Faculty:
     def days(self):
         return self.periods // self.periods_per_day
 
+    def conflict_mask(self, c: int) -> np.ndarray:
+        """Get (courses,) bool mask of courses conflicting with c"""
+        return self.conflict_np[c]
+
+    @cached_property
+    def data(self) -> FacultyData:
+        return FacultyData(
+            lectures=self.lectures_np,
+            min_working_days=self.min_working_days_np,
+            students=self.students_np,
+            capacity=self.capacity_np,
+            course_curricula_indptr=self.course_curricula_indptr_np,
+            course_curricula_indices=self.course_curricula_indices_np,
+            conflict_indptr=self.conflict_indptr_np,
+            conflict_indices=self.conflict_indices_np,
+            conflict_bits=self.conflict_bits_np,
+            availability=self.availability_np,
+            availability_bits=self.availability_bits_np,
+            periods_per_day=self.periods_per_day,
+            min_working_days_cost=self.MIN_WORKING_DAYS_COST,
+            curriculum_compactness_cost=self.CURRICULUM_COMPACTNESS_COST,
+            room_stability_cost=self.ROOM_STABILITY_COST,
+        )
+
     @classmethod
     def from_stream(cls, buffer: IO):
-        no_availability_py = defaultdict(bool)
-
-        def get_value(stream: IO, index: int = 1, separator: str = None) -> str:
-            return next(stream).split(separator)[index]
-
-        name = get_value(buffer)
-        courses = int(get_value(buffer))
-        rooms = int(get_value(buffer))
-        days = int(get_value(buffer))
-        periods_per_day = int(get_value(buffer))
-        curricula = int(get_value(buffer))
-        constraints = int(get_value(buffer))
-        next(buffer)
+        no_availability_py = set()
+        # Whole input is tokenized at once, blank lines vanish and section titles are single tokens
+        tokens = iter(buffer.read().split())
+
+        def get_value() -> str:
+            next(tokens)  # title
+            return next(tokens)
+
+        name = get_value()
+        courses = int(get_value())
+        rooms = int(get_value())
+        days = int(get_value())
+        periods_per_day = int(get_value())
+        curricula = int(get_value())
+        constraints = int(get_value())
 
         periods = days * periods_per_day
-        availability = [[True for i in range(periods)] for i in range(courses)]
-        conflict: List[Set[int]] = [set() for i in range(courses)]
+        availability_np = np.ones((courses, periods), dtype=np.bool_)
+        conflict_np = np.zeros((courses, courses), dtype=np.bool_)
 
-        next(buffer)
-        course_vect = [Course.from_buffer(buffer) for _ in range(courses)]
-        next(buffer)
+        next(tokens)  # COURSES:
+        course_vect = [Course.from_tokens(tokens) for _ in range(courses)]
         course_names = [c.name for c in course_vect]
+        # First occurrence wins, same as course_names.index
+        course_index = {name: i for i, name in reversed(list(enumerate(course_names)))}
         course_conflict_weights = [0 for _ in range(courses)]
 
-        next(buffer)
-        room_vect = [Room.from_buffer(buffer) for _ in range(rooms)]
-        next(buffer)
+        next(tokens)  # ROOMS:
+        room_vect = [Room.from_tokens(tokens) for _ in range(rooms)]
 
-        next(buffer)
+        next(tokens)  # CURRICULA:
         curricula_vect = []
+        curriculum_members_np = np.zeros((curricula, courses), dtype=np.bool_)
         for i in range(curricula):
-            curricula_ = Curriculum.from_buffer(buffer)
+            curricula_ = Curriculum.from_tokens(tokens)
+            for member in curricula_.members:
+                curriculum_members_np[i, course_index[member]] = True
             for c1, c2 in combinations(curricula_.members, 2):
-                i1, i2 = course_names.index(c1), course_names.index(c2)
+                i1, i2 = course_index[c1], course_index[c2]
                 course_conflict_weights[i1] += 1
                 course_conflict_weights[i2] += 1
-                conflict[i1].add(i2)
-                conflict[i2].add(i1)
+                conflict_np[i1, i2] = conflict_np[i2, i1] = True
             curricula_vect.append(curricula_)
-        next(buffer)
 
-        next(buffer)
+        next(tokens)  # UNAVAILABILITY_CONSTRAINTS:
         for i in range(constraints):
-            course_name, day_index, period_index = next(buffer).split()
+            course_name, day_index, period_index = next(tokens), next(tokens), next(tokens)
             p = int(day_index) * periods_per_day + int(period_index)
-            c = course_names.index(course_name)
-            availability[c][p] = False
-            no_availability_py[(course_name, p)] = True
+            c = course_index[course_name]
+            availability_np[c, p] = False
+            no_availability_py.add((course_name, p))
             course_conflict_weights[c] += 1
 
-        # Add same-teacher constraints
-        for i1, i2 in combinations(range(len(course_vect)), 2):
-            c1, c2 = course_vect[i1], course_vect[i2]
-            if c1.teacher == c2.teacher:
-                conflict[i1].add(i2)
-                conflict[i2].add(i1)
+        # Add same-teacher constraints, only pairs within each teacher's courses
+        teacher_courses = defaultdict(list)
+        for i, course in enumerate(course_vect):
+            teacher_courses[course.teacher].append(i)
+        for same_teacher in teacher_courses.values():
+            for i1, i2 in combinations(same_teacher, 2):
+                conflict_np[i1, i2] = conflict_np[i2, i1] = True
                 course_conflict_weights[i1] += 1
                 course_conflict_weights[i2] += 1
 
@@ -156,6 +220,10 @@ class Faculty:
             # Add lectures multiplier
             course_conflict_weights[c] *= course_vect[c].lectures
 
+        curriculum_indptr_np, curriculum_indices_np = _csr(curriculum_members_np)
+        course_curricula_indptr_np, course_curricula_indices_np = _csr(curriculum_members_np.T)
+        conflict_indptr_np, conflict_indices_np = _csr(conflict_np)
+
         instance = cls(
             name=name,
             rooms=rooms,
@@ -166,45 +234,72 @@ class Faculty:
             course_vect=course_vect,
             room_vect=room_vect,
             curricula_vect=curricula_vect,
-            availability=availability,
-            conflict=conflict,
-            no_availability_py=no_availability_py,
+            no_availability_py=frozenset(no_availability_py),
             course_names=course_names,
+            course_index=course_index,
+            room_names=[room.name for room in room_vect],
+            room_index={room.name: r for r, room in reversed(list(enumerate(room_vect, 1)))},
             course_conflict_weights=course_conflict_weights,
+            lectures_np=np.array([c.lectures for c in course_vect], dtype=np.int32),
+            min_working_days_np=np.array([c.min_working_days for c in course_vect], dtype=np.int32),
+            students_np=np.array([c.students for c in course_vect], dtype=np.int32),
+            capacity_np=np.array([r.capacity for r in room_vect], dtype=np.int32),
+            curriculum_indptr_np=curriculum_indptr_np,
+            curriculum_indices_np=curriculum_indices_np,
+            course_curricula_indptr_np=course_curricula_indptr_np,
+            course_curricula_indices_np=course_curricula_indices_np,
+            conflict_np=conflict_np,
+            conflict_indptr_np=conflict_indptr_np,
+            conflict_indices_np=conflict_indices_np,
+            conflict_bits_np=_pack_bits(conflict_np),
+            availability_np=availability_np,
+            availability_bits_np=_pack_bits(availability_np),
+            day_of_np=np.arange(periods, dtype=np.int32) // periods_per_day,
+            timeslot_of_np=np.arange(periods, dtype=np.int32) % periods_per_day,
         )
         return instance
 
 
 @dataclass
 class Timetable:
+    __slots__ = (
+        'faculty',
+        'timetable',
+        'room_lectures',
+        'curriculum_period_lectures',
+        'course_daily_lectures',
+        'working_days',
+        'course_room_lectures',
+    )
+
     faculty: Faculty
-    timetable: List[List[int]]  # (courses X periods) timetable matrix
+    timetable: np.ndarray  # (courses X periods) int16 timetable matrix, room index or 0
 
     # redundant data
     # number of lectures per room in the same period (should be 0 or 1)
-    room_lectures: List[List[int]]
+    room_lectures: np.ndarray  # (rooms + 1 X periods) int32
     # number of lectures per curriculum in the same period (should be 0 or 1)
-    curriculum_period_lectures: List[List[int]]
+    curriculum_period_lectures: np.ndarray  # (curricula X periods) int32
     # number of lectures per course per day
-    course_daily_lectures: List[List[int]]
+    course_daily_lectures: np.ndarray  # (courses X days) int32
     # number of days of lecture per course
-    working_days: List[int]
-    # rooms used for each lecture on the course
-    used_rooms: List[List[int]]
+    working_days: np.ndarray  # (courses,) int32
+    # number of lectures per course per room, nonzero entries are the used rooms
+    course_room_lectures: np.ndarray  # (courses X rooms + 1) int32
 
     def __eq__(self, other):
         if not isinstance(other, Timetable):
             return NotImplemented
-        return self.faculty is other.faculty and self.timetable == other.timetable
+        return self.faculty is other.faculty and np.array_equal(self.timetable, other.timetable)
 
     @classmethod
     def from_faculty(cls, faculty: Faculty) -> 'Timetable':
-        tt = [[0 for i in range(faculty.periods)] for i in range(faculty.courses)]
-        room_lectures = [[0 for i in range(faculty.periods)] for i in range(faculty.rooms + 1)]
-        curriculum_period_lectures = [[0 for i in range(faculty.periods)] for i in range(faculty.curricula)]
-        course_daily_lectures = [[0 for i in range(faculty.days)] for i in range(faculty.courses)]
-        working_days = [0 for i in range(faculty.courses)]
-        used_rooms: List[List[int]] = [[] for i in range(faculty.courses)]  # ?
+        tt = np.zeros((faculty.courses, faculty.periods), dtype=np.int16)
+        room_lectures = np.zeros((faculty.rooms + 1, faculty.periods), dtype=np.int32)
+        curriculum_period_lectures = np.zeros((faculty.curricula, faculty.periods), dtype=np.int32)
+        course_daily_lectures = np.zeros((faculty.courses, faculty.days), dtype=np.int32)
+        working_days = np.zeros(faculty.courses, dtype=np.int32)
+        course_room_lectures = np.zeros((faculty.courses, faculty.rooms + 1), dtype=np.int32)
 
         instance = cls(
             faculty=faculty,
@@ -213,32 +308,43 @@ class Timetable:
             curriculum_period_lectures=curriculum_period_lectures,
             course_daily_lectures=course_daily_lectures,
             working_days=working_days,
-            used_rooms=used_rooms,
+            course_room_lectures=course_room_lectures,
         )
         return instance
 
+    @classmethod
+    def from_grid(cls, faculty: Faculty, grid: np.ndarray) -> 'Timetable':
+        instance = cls.from_faculty(faculty)
+        instance.timetable = grid
+        instance.update_redundant_data()
+        return instance
+
     def clone(self):
-        new_timetable = self.from_faculty(self.faculty)
-        new_timetable.timetable = deepcopy(self.timetable)
-        return new_timetable
+        # Faculty is shared, only the mutable tables are copied
+        return replace(
+            self,
+            timetable=self.timetable.copy(),
+            room_lectures=self.room_lectures.copy(),
+            curriculum_period_lectures=self.curriculum_period_lectures.copy(),
+            course_daily_lectures=self.course_daily_lectures.copy(),
+            working_days=self.working_days.copy(),
+            course_room_lectures=self.course_room_lectures.copy(),
+        )
 
     @classmethod
     def from_stream(cls, faculty: Faculty, buffer: IO):
         instance = cls.from_faculty(faculty)
-        room_names = [r.name for r in faculty.room_vect]
 
         for line in buffer:
             course_name, room_name, day, period = line.split()
             day, period = int(day), int(period)
 
-            try:
-                c = faculty.course_names.index(course_name)
-            except ValueError:
+            c = faculty.course_index.get(course_name)
+            if c is None:
                 logger.warning('Nonexisting course %s (entry skipped)', course_name)
                 continue
-            try:
-                r = room_names.index(room_name) + 1
-            except ValueError:
+            r = faculty.room_index.get(room_name)
+            if r is None:
                 logger.warning('Nonexisting room %s (entry skipped)', room_name)
                 continue
             if day > faculty.days:
@@ -249,52 +355,74 @@ class Timetable:
                 continue
             p = day * faculty.periods_per_day + period
 
-            if instance.timetable[c][p]:
+            if instance.timetable[c, p]:
                 logger.warning('Repeated entry: %s (entry skipped)', line.strip())
                 continue
 
-            instance.timetable[c][p] = r
+            instance.assign(c, p, r)
 
-        instance.update_redundant_data()
         return instance
 
     def to_stream(self, buffer: IO):
-        for c in range(self.faculty.courses):
-            for p in range(self.faculty.periods):
-                room = self.timetable[c][p]
-                if room:
-                    room_name = self.faculty.room_vect[room - 1].name
-                    course_name = self.faculty.course_vect[c].name
-                    day, period = divmod(p, self.faculty.periods_per_day)
-                    buffer.write(f'{course_name} {room_name} {day} {period}\n')
-
-    def update_redundant_data(self):  # noqa: C901
-        for c in range(self.faculty.courses):
-            for p in range(self.faculty.periods):
-                room = self.timetable[c][p]
-                if room:
-                    # 1
-                    self.room_lectures[room][p] += 1
-
-                    # 5
-                    if room not in self.used_rooms[c]:
-                        self.used_rooms[c].append(room)
-
-        for ci, c in enumerate(self.faculty.course_vect):
-            for gi, g in enumerate(self.faculty.curricula_vect):
-                if c.name in g.members:
-                    for p in range(self.faculty.periods):
-                        if self.timetable[ci][p]:
-                            # 2
-                            self.curriculum_period_lectures[gi][p] += 1
-
-        for c in range(self.faculty.courses):
-            for d in range(self.faculty.days):
-                for p_ in range(self.faculty.periods_per_day):
-                    p = d * self.faculty.periods_per_day + p_
-                    if self.timetable[c][p]:
-                        # 3
-                        self.course_daily_lectures[c][d] += 1
-                if self.course_daily_lectures[c][d] > 0:
-                    # 4
-                    self.working_days[c] += 1
+        # Whole solution goes out in one write call
+        course_names, room_names = self.faculty.course_names, self.faculty.room_names
+        cs, ps = np.nonzero(self.timetable)
+        lines = [
+            f'{course_names[c]} {room_names[room - 1]} {day} {timeslot}\n'
+            for c, room, day, timeslot in zip(
+                cs.tolist(),
+                self.timetable[cs, ps].tolist(),
+                self.faculty.day_of_np[ps].tolist(),
+                self.faculty.timeslot_of_np[ps].tolist(),
+            )
+        ]
+        buffer.write(''.join(lines))
+
+    def assign(self, c: int, p: int, room: int):
+        """Put lecture of course c to room at (free) period p, keeping redundant data in sync"""
+        self.timetable[c, p] = room
+        self.room_lectures[room, p] += 1
+        self.course_room_lectures[c, room] += 1
+        indptr = self.faculty.course_curricula_indptr_np
+        for g in self.faculty.course_curricula_indices_np[indptr[c]:indptr[c + 1]]:
+            self.curriculum_period_lectures[g, p] += 1
+        d = p // self.faculty.periods_per_day
+        if not self.course_daily_lectures[c, d]:
+            self.working_days[c] += 1
+        self.course_daily_lectures[c, d] += 1
+
+    def clear(self, c: int, p: int):
+        """Remove lecture of course c at period p (if any), keeping redundant data in sync"""
+        room = self.timetable[c, p]
+        if not room:
+            return
+        self.timetable[c, p] = 0
+        self.room_lectures[room, p] -= 1
+        self.course_room_lectures[c, room] -= 1
+        indptr = self.faculty.course_curricula_indptr_np
+        for g in self.faculty.course_curricula_indices_np[indptr[c]:indptr[c + 1]]:
+            self.curriculum_period_lectures[g, p] -= 1
+        d = p // self.faculty.periods_per_day
+        self.course_daily_lectures[c, d] -= 1
+        if not self.course_daily_lectures[c, d]:
+            self.working_days[c] -= 1
+
+    def move(self, c: int, from_p: int, to_p: int, room: int):
+        self.clear(c, from_p)
+        self.assign(c, to_p, room)
+
+    def update_redundant_data(self):
+        faculty = self.faculty
+        room_lectures, curriculum_period_lectures, course_daily_lectures, course_room_lectures = _lecture_tables(
+            self.timetable,
+            faculty.course_curricula_indptr_np,
+            faculty.course_curricula_indices_np,
+            faculty.curricula,
+            faculty.rooms,
+            faculty.periods_per_day,
+        )
+        self.room_lectures = room_lectures
+        self.curriculum_period_lectures = curriculum_period_lectures
+        self.course_daily_lectures = course_daily_lectures
+        self.working_days = np.count_nonzero(course_daily_lectures, axis=1).astype(np.int32)
+        self.course_room_lectures = course_room_lectures
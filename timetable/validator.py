@@ -1,112 +1,166 @@
 import logging
+import sys
 from dataclasses import dataclass
-from functools import cached_property
+from itertools import chain
+from typing import Any, Callable, Generic, Iterable, Iterator, Optional, Sequence, Tuple, TypeVar
 
 import click
+import numpy as np
 
+from ._kernels import (
+    Counters, _apply_moves, _build_counters, _conflicts_cost, _curriculum_compactness_kernel, _timetable_costs_kernel,
+)
 from .structures import Faculty, Timetable
 
-logger = logging.getLogger(__name__)
+# (course, old period, new period, old room, new room)
+Move = Tuple[int, int, int, int, int]
 
+T = TypeVar('T')
 
-@dataclass
+
+class cached_property(Generic[T]):
+    """Lock free functools.cached_property, validator is used from a single thread
+    Value is stored in the instance __dict__ and shadows the (non-data)
+    descriptor, so later reads are plain attribute lookups
+    """
+
+    def __init__(self, func: Callable[[Any], T]):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __set_name__(self, owner: type, name: str):
+        self.name = name
+
+    def __get__(self, instance: Any, owner: Optional[type] = None) -> T:
+        if instance is None:
+            return self  # type: ignore[return-value]
+        value = instance.__dict__[self.name] = self.func(instance)
+        return value
+
+
+def _write_lines(lines: Iterable[str]):
+    # One write call instead of a print per line
+    sys.stdout.write(''.join(f'{line}\n' for line in lines))
+
+
+# Identity equality and hashing, generated __eq__ would compare whole faculties and timetables
+@dataclass(eq=False)
 class Validator:
     faculty: Faculty
     timetable: Timetable
 
-    def _period(self, period):
-        day, timeslot = divmod(period, self.faculty.periods_per_day)
-        return f'period {period} (day {day}, timeslot {timeslot})'
+    @cached_property
+    def _period_names(self) -> Tuple[str, ...]:
+        """Period descriptions for violation messages, formatted once per period"""
+        return tuple(
+            f'period {p} (day {day}, timeslot {timeslot})'
+            for p, (day, timeslot) in enumerate(zip(
+                self.faculty.day_of_np.tolist(),
+                self.faculty.timeslot_of_np.tolist(),
+            ))
+        )
+
+    @cached_property
+    def counters(self) -> Counters:
+        tt = self.timetable.timetable.copy()
+        return Counters(tt, *_build_counters(
+            tt,
+            self.faculty.course_curricula_indptr_np,
+            self.faculty.course_curricula_indices_np,
+            self.faculty.curricula,
+            self.faculty.rooms,
+            self.faculty.periods_per_day,
+        ))
+
+    def delta_cost(self, moves: Sequence[Move]) -> Tuple[int, int]:
+        """Get (violations, soft cost) change caused by moves, without applying them
+        Counters start from self.timetable and only change on commit, so
+        costs_on_* properties keep describing the original timetable
+        """
+        if not moves:
+            return 0, 0
+        violations, soft = _apply_moves(self.counters, self.faculty.data, np.array(moves, dtype=np.int64), False)
+        return int(violations), int(soft)
+
+    def commit(self, moves: Sequence[Move]):
+        if moves:
+            _apply_moves(self.counters, self.faculty.data, np.array(moves, dtype=np.int64), True)
+
+    @cached_property
+    def _lectures_surplus(self) -> np.ndarray:
+        """Scheduled minus required lectures per course, shared by cost and report"""
+        return np.count_nonzero(self.timetable.timetable, axis=1) - self.faculty.lectures_np
+
+    @cached_property
+    def _unavailable_lectures(self) -> np.ndarray:
+        """(course, period) pairs of lectures at unavailable periods, shared by cost and report"""
+        return np.argwhere((self.timetable.timetable != 0) & ~self.faculty.availability_np)
+
+    @cached_property
+    def _isolated_lectures(self) -> np.ndarray:
+        """(curricula X periods) lectures with no lecture of the same curriculum in adjacent timeslots"""
+        shape = self.faculty.curricula, self.faculty.days, self.faculty.periods_per_day
+        lectures = self.timetable.curriculum_period_lectures.reshape(shape)
+        busy = lectures != 0
+        neighbours = np.zeros_like(busy)
+        neighbours[..., 1:] |= busy[..., :-1]
+        neighbours[..., :-1] |= busy[..., 1:]
+        return np.where(neighbours, 0, lectures).reshape(self.timetable.curriculum_period_lectures.shape)
+
+    @cached_property
+    def _soft_costs(self) -> Tuple[int, int, int]:
+        """(room capacity, min working days, room stability) costs in one pass"""
+        kernel = _timetable_costs_kernel(self.faculty.periods_per_day, self.faculty.days)
+        room_capacity, min_working_days, room_stability = kernel(
+            self.timetable.timetable,
+            self.faculty.students_np,
+            self.faculty.capacity_np,
+            self.faculty.min_working_days_np,
+            self.faculty.rooms,
+        )
+        return int(room_capacity), int(min_working_days), int(room_stability)
 
     @cached_property
     def costs_on_lectures(self) -> int:
-        cost = 0
-        for c in range(self.faculty.courses):
-            lectures = 0
-            for p in range(self.faculty.periods):
-                if self.timetable.timetable[c][p]:
-                    lectures += 1
-            if lectures < self.faculty.course_vect[c].lectures:
-                cost += self.faculty.course_vect[c].lectures - lectures
-            elif lectures > self.faculty.course_vect[c].lectures:
-                cost += lectures - self.faculty.course_vect[c].lectures
-        return cost
+        return int(np.abs(self._lectures_surplus).sum())
 
     @cached_property
     def costs_on_conflicts(self) -> int:
-        cost = 0
-        covered = set()
-        for c1 in range(self.faculty.courses):
-            covered.add(c1)
-            for c2 in self.faculty.conflict[c1] - covered:
-                for p in range(self.faculty.periods):
-                    if self.timetable.timetable[c1][p] and self.timetable.timetable[c2][p]:
-                        cost += 1
-        return cost
+        return int(_conflicts_cost(
+            self.timetable.timetable,
+            self.faculty.conflict_indptr_np,
+            self.faculty.conflict_indices_np,
+        ))
 
     @cached_property
     def costs_on_availability(self) -> int:
-        cost = 0
-        for c in range(self.faculty.courses):
-            for p in range(self.faculty.periods):
-                if self.timetable.timetable[c][p] and not self.faculty.availability[c][p]:
-                    cost += 1
-        return cost
+        return len(self._unavailable_lectures)
 
     @cached_property
     def costs_on_room_occupation(self) -> int:
-        cost = 0
-        for p in range(self.faculty.periods):
-            for r in range(self.faculty.rooms + 1):
-                if self.timetable.room_lectures[r][p] > 1:
-                    cost += (self.timetable.room_lectures[r][p] - 1)
-        return cost
+        return int(np.maximum(self.timetable.room_lectures - 1, 0).sum())
 
     @cached_property
     def costs_on_room_capacity(self) -> int:
-        cost = 0
-        for c in range(self.faculty.courses):
-            for p in range(self.faculty.periods):
-                r = self.timetable.timetable[c][p]
-                if r and self.faculty.room_vect[r - 1].capacity < self.faculty.course_vect[c].students:
-                    cost += self.faculty.course_vect[c].students - self.faculty.room_vect[r - 1].capacity
-        return cost
+        return self._soft_costs[0]
 
     @cached_property
     def costs_on_min_working_days(self) -> int:
-        cost = 0
-        for c in range(self.faculty.courses):
-            if self.timetable.working_days[c] < self.faculty.course_vect[c].min_working_days:
-                cost += self.faculty.course_vect[c].min_working_days - self.timetable.working_days[c]
-        return cost
+        return self._soft_costs[1]
 
     @cached_property
     def costs_on_curriculum_compactness(self) -> int:
-        cost = 0
-        ppd = self.faculty.periods_per_day
-        for g in range(self.faculty.curricula):
-            for p in range(self.faculty.periods):
-                if not self.timetable.curriculum_period_lectures[g][p]:
-                    continue
-                if p % ppd == 0:
-                    if not self.timetable.curriculum_period_lectures[g][p + 1]:
-                        cost += self.timetable.curriculum_period_lectures[g][p]
-                elif (p + 1) % ppd == 0:
-                    if not self.timetable.curriculum_period_lectures[g][p - 1]:
-                        cost += self.timetable.curriculum_period_lectures[g][p]
-                elif not (self.timetable.curriculum_period_lectures[g][p + 1]
-                          or self.timetable.curriculum_period_lectures[g][p - 1]):
-                    cost += self.timetable.curriculum_period_lectures[g][p]
-        return cost
+        kernel = _curriculum_compactness_kernel(self.faculty.periods_per_day, self.faculty.days)
+        return int(kernel(
+            self.timetable.timetable,
+            self.faculty.curriculum_indptr_np,
+            self.faculty.curriculum_indices_np,
+        ))
 
     @cached_property
     def costs_on_room_stability(self) -> int:
-        cost = 0
-        for c in range(self.faculty.courses):
-            rooms = len(self.timetable.used_rooms[c])
-            if rooms > 1:
-                cost += rooms - 1
-        return cost
+        return self._soft_costs[2]
 
     @cached_property
     def total_violation_cost(self) -> int:
@@ -117,6 +171,15 @@ class Validator:
             self.costs_on_room_occupation,
         ])
 
+    def feasible(self) -> bool:
+        """Check hard constraints only, stopping at the first violated one"""
+        return not (
+            self.costs_on_lectures
+            or self.costs_on_conflicts
+            or self.costs_on_availability
+            or self.costs_on_room_occupation
+        )
+
     @cached_property
     def total_soft_cost(self) -> int:
         return sum([
@@ -127,120 +190,102 @@ class Validator:
         ])
 
     def print_violations(self):
-        self.print_violations_on_lectures()
-        self.print_violations_on_conflicts()
-        self.print_violations_on_availability()
-        self.print_violations_on_room_occupation()
-        self.print_violations_on_room_capacity()
-        self.print_violations_on_min_working_days()
-        self.print_violations_on_curriculum_compactness()
-        self.print_violations_on_room_stability()
+        lines = list(chain(
+            self.violations_on_lectures(),
+            self.violations_on_conflicts(),
+            self.violations_on_availability(),
+            self.violations_on_room_occupation(),
+            self.violations_on_room_capacity(),
+            self.violations_on_min_working_days(),
+            self.violations_on_curriculum_compactness(),
+            self.violations_on_room_stability(),
+        ))
         if self.total_violation_cost or self.total_soft_cost:
-            print()
+            lines.append('')
+        _write_lines(lines)
 
     def print_costs(self):
-        print(f'Violations of Lectures (hard) : {self.costs_on_lectures}')
-        print(f'Violations of Conflicts (hard) : {self.costs_on_conflicts}')
-        print(f'Violations of Availability (hard) : {self.costs_on_availability}')
-        print(f'Violations of RoomOccupation (hard) : {self.costs_on_room_occupation}')
-        print(f'Cost of RoomCapacity (soft) : {self.costs_on_room_capacity}')
-        print(f'Cost of MinWorkingDays (soft) : {self.costs_on_min_working_days * self.faculty.MIN_WORKING_DAYS_COST}')
         cc_costs = self.costs_on_curriculum_compactness * self.faculty.CURRICULUM_COMPACTNESS_COST
-        print(f'Cost of CurriculumCompactness (soft) : {cc_costs}')
-        print(f'Cost of RoomStability (soft) : {self.costs_on_room_stability * self.faculty.ROOM_STABILITY_COST}')
-        print()
+        _write_lines([
+            f'Violations of Lectures (hard) : {self.costs_on_lectures}',
+            f'Violations of Conflicts (hard) : {self.costs_on_conflicts}',
+            f'Violations of Availability (hard) : {self.costs_on_availability}',
+            f'Violations of RoomOccupation (hard) : {self.costs_on_room_occupation}',
+            f'Cost of RoomCapacity (soft) : {self.costs_on_room_capacity}',
+            f'Cost of MinWorkingDays (soft) : {self.costs_on_min_working_days * self.faculty.MIN_WORKING_DAYS_COST}',
+            f'Cost of CurriculumCompactness (soft) : {cc_costs}',
+            f'Cost of RoomStability (soft) : {self.costs_on_room_stability * self.faculty.ROOM_STABILITY_COST}',
+            '',
+        ])
 
     def print_total_cost(self):
-        print('Summary: ', end='')
         violations = self.total_violation_cost
         costs = self.total_soft_cost
         parts = []
         if violations:
             parts.append(f'Violations = {violations}')
         parts.append(f'Total Cost = {costs}')
-        print(', '.join(parts))
-
-    def print_violations_on_lectures(self):
-        for c in range(self.faculty.courses):
-            lectures = 0
-            for p in range(self.faculty.periods):
-                if self.timetable.timetable[c][p]:
-                    lectures += 1
-            if lectures < self.faculty.course_vect[c].lectures:
-                print(f'[H] Too few lectures for course {self.faculty.course_vect[c].name}')
-            if lectures > self.faculty.course_vect[c].lectures:
-                print(f'[H] Too many lectures for course {self.faculty.course_vect[c].name}')
-
-    def print_violations_on_conflicts(self):
-        covered = set()
+        _write_lines([f'Summary: {", ".join(parts)}'])
+
+    def violations_on_lectures(self) -> Iterator[str]:
+        for c in np.flatnonzero(self._lectures_surplus).tolist():
+            if self._lectures_surplus[c] < 0:
+                yield f'[H] Too few lectures for course {self.faculty.course_names[c]}'
+            else:
+                yield f'[H] Too many lectures for course {self.faculty.course_names[c]}'
+
+    def violations_on_conflicts(self) -> Iterator[str]:
+        indptr, indices = self.faculty.conflict_indptr_np, self.faculty.conflict_indices_np
         for c1 in range(self.faculty.courses):
-            covered.add(c1)
-            for c2 in self.faculty.conflict[c1] - covered:
-                for p in range(self.faculty.periods):
-                    if self.timetable.timetable[c1][p] and self.timetable.timetable[c2][p]:
-                        c1_name = self.faculty.course_vect[c1].name
-                        c2_name = self.faculty.course_vect[c2].name
-                        print(f'[H] Courses {c1_name} and {c2_name} have both a lecture at {self._period(p)}')
-
-    def print_violations_on_availability(self):
-        for c in range(self.faculty.courses):
-            for p in range(self.faculty.periods):
-                if self.timetable.timetable[c][p] and not self.faculty.availability[c][p]:
-                    print(f'[H] Course {self.faculty.course_vect[c].name} has a lecture '
-                          f'at unavailable {self._period(p)}')
-
-    def print_violations_on_room_occupation(self):
-        for p in range(self.faculty.periods):
-            for r in range(self.faculty.rooms + 1):
-                if self.timetable.room_lectures[r][p] > 1:
-                    print(f'[H] {self.timetable.room_lectures[r][p]} lectures in room'
-                          f' {self.faculty.room_vect[r - 1].name} the {self._period(p)}', end='')
-                    if self.timetable.room_lectures[r][p] > 2:
-                        print(f' [{self.timetable.room_lectures[r][p] - 1} violations]', end='')
-                    print()
-
-    def print_violations_on_room_capacity(self):
-        for c in range(self.faculty.courses):
-            for p in range(self.faculty.periods):
-                r = self.timetable.timetable[c][p]
-                if r and self.faculty.room_vect[r - 1].capacity < self.faculty.course_vect[c].students:
-                    cost = self.faculty.course_vect[c].students - self.faculty.room_vect[r - 1].capacity
-                    print(f'[S({cost})] Room {self.faculty.room_vect[r - 1].name} too small '
-                          f'for course {self.faculty.course_vect[c].name} the {self._period(p)}')
-
-    def print_violations_on_min_working_days(self):
-        for c in range(self.faculty.courses):
-            if self.timetable.working_days[c] < self.faculty.course_vect[c].min_working_days:
-                print(f'[S({self.faculty.MIN_WORKING_DAYS_COST})] The course {self.faculty.course_vect[c].name} '
-                      f'has only {self.timetable.working_days[c]} days of lecture')
-
-    def print_violations_on_curriculum_compactness(self):
-        ppd = self.faculty.periods_per_day
-        for g in range(self.faculty.curricula):
-            for p in range(self.faculty.periods):
-                if not self.timetable.curriculum_period_lectures[g][p]:
+            for c2 in indices[indptr[c1]:indptr[c1 + 1]]:
+                if c2 <= c1:
                     continue
-                cost = 0
-                if p % ppd == 0:
-                    if not self.timetable.curriculum_period_lectures[g][p + 1]:
-                        cost = self.timetable.curriculum_period_lectures[g][p]
-                elif (p + 1) % ppd == 0:
-                    if not self.timetable.curriculum_period_lectures[g][p - 1]:
-                        cost = self.timetable.curriculum_period_lectures[g][p]
-                elif not (self.timetable.curriculum_period_lectures[g][p + 1]
-                          or self.timetable.curriculum_period_lectures[g][p - 1]):
-                    cost = self.timetable.curriculum_period_lectures[g][p]
-                if cost:
-                    cost *= self.faculty.CURRICULUM_COMPACTNESS_COST
-                    print(f'[S({cost})] Curriculum {self.faculty.curricula_vect[g].name} '
-                          f'has an isolated lecture at {self._period(p)}')
-
-    def print_violations_on_room_stability(self):
-        for c in range(self.faculty.courses):
-            rooms = len(self.timetable.used_rooms[c])
-            if rooms > 1:
-                cost = (rooms - 1) * self.faculty.ROOM_STABILITY_COST
-                print(f'[S({cost})] Course {self.faculty.course_vect[c].name} uses {rooms} different rooms')
+                c1_name = self.faculty.course_names[c1]
+                c2_name = self.faculty.course_names[c2]
+                both = (self.timetable.timetable[c1] != 0) & (self.timetable.timetable[c2] != 0)
+                for p in np.flatnonzero(both).tolist():
+                    yield f'[H] Courses {c1_name} and {c2_name} have both a lecture at {self._period_names[p]}'
+
+    def violations_on_availability(self) -> Iterator[str]:
+        for c, p in self._unavailable_lectures.tolist():
+            yield f'[H] Course {self.faculty.course_names[c]} has a lecture at unavailable {self._period_names[p]}'
+
+    def violations_on_room_occupation(self) -> Iterator[str]:
+        # Transposed, so violations come out period by period
+        for p, r in np.argwhere(self.timetable.room_lectures.T > 1).tolist():
+            lectures = self.timetable.room_lectures[r, p]
+            line = f'[H] {lectures} lectures in room {self.faculty.room_names[r - 1]} the {self._period_names[p]}'
+            if lectures > 2:
+                line += f' [{lectures - 1} violations]'
+            yield line
+
+    def violations_on_room_capacity(self) -> Iterator[str]:
+        tt = self.timetable.timetable
+        # Gather capacities of the assigned rooms, unassigned cells borrow the first room and are masked out
+        deficit = self.faculty.students_np[:, None] - self.faculty.capacity_np[np.maximum(tt - 1, 0)]
+        deficit[tt == 0] = 0
+        for c, p in np.argwhere(deficit > 0).tolist():
+            yield (f'[S({deficit[c, p]})] Room {self.faculty.room_names[tt[c, p] - 1]} too small '
+                   f'for course {self.faculty.course_names[c]} the {self._period_names[p]}')
+
+    def violations_on_min_working_days(self) -> Iterator[str]:
+        working_days = self.timetable.working_days
+        for c in np.flatnonzero(working_days < self.faculty.min_working_days_np).tolist():
+            yield (f'[S({self.faculty.MIN_WORKING_DAYS_COST})] The course {self.faculty.course_names[c]} '
+                   f'has only {working_days[c]} days of lecture')
+
+    def violations_on_curriculum_compactness(self) -> Iterator[str]:
+        for g, p in np.argwhere(self._isolated_lectures).tolist():
+            cost = self._isolated_lectures[g, p] * self.faculty.CURRICULUM_COMPACTNESS_COST
+            yield (f'[S({cost})] Curriculum {self.faculty.curricula_vect[g].name} '
+                   f'has an isolated lecture at {self._period_names[p]}')
+
+    def violations_on_room_stability(self) -> Iterator[str]:
+        used_rooms = np.count_nonzero(self.timetable.course_room_lectures[:, 1:], axis=1)
+        for c in np.flatnonzero(used_rooms > 1).tolist():
+            rooms = used_rooms[c]
+            cost = (rooms - 1) * self.faculty.ROOM_STABILITY_COST
+            yield f'[S({cost})] Course {self.faculty.course_names[c]} uses {rooms} different rooms'
 
 
 def make_validator(faculty_stream, timetable_stream) -> Validator: